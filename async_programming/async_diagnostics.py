@@ -0,0 +1,243 @@
+"""
+This file defines a set of tools to find out what slows down an async run:
+- `EventLoopLagMonitor` measures how late the event loop wakes up. A large lag means something is blocking the loop.
+- `PhaseTimer` records how long each request spends waiting for a slot, sending, awaiting the response, and parsing it.
+- `SamplingProfiler` samples the stack of the event loop thread and writes flamegraph-ready output.
+
+See `async_template.py` for how to use them.
+
+Author: Kaicheng Yang <yang3kc@gmail.com>
+"""
+
+import asyncio
+import contextvars
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    if len(values) > 1:
+        percentiles = statistics.quantiles(values, n=100, method="inclusive")
+        p50, p95 = percentiles[49], percentiles[94]
+    else:
+        p50 = p95 = values[0]
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values),
+        "p50": p50,
+        "p95": p95,
+        "max": max(values),
+    }
+
+
+#######################################
+# Event loop lag
+
+
+class EventLoopLagMonitor:
+    """Measure how late the event loop runs a callback that should run every `interval` seconds.
+
+    While the loop is free, the lag stays close to zero.
+    When a coroutine does CPU work without awaiting (parsing, printing, updating progress bars),
+    every other coroutine has to wait, and the lag goes up.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start_time = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start_time - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._sample())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def summary(self):
+        return summarize(self.lags)
+
+
+#######################################
+# Per-request phase timing
+
+# Each asyncio task runs in its own copy of the context,
+# so this points to the record of the request handled by the current task
+_current_record = contextvars.ContextVar("phase_record", default=None)
+
+
+class PhaseRecord:
+    def __init__(self, label, enabled=True):
+        self.label = label
+        self.enabled = enabled
+        self.phases = {}
+        self._last_mark = time.perf_counter()
+
+    def mark(self, phase):
+        """Close the current phase and name it `phase`."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        # A phase can be marked more than once, e.g. "retry" when the client retries several times
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last_mark
+        self._last_mark = now
+
+
+class PhaseTimer:
+    """Collect the time each request spends in each phase.
+
+    Call `start()` at the beginning of a request and `record.mark(phase)` at the end of each phase.
+    If `enabled` is False, the records do nothing, so the timer can stay in the code at no cost.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+
+    def start(self, label=None):
+        record = PhaseRecord(label, enabled=self.enabled)
+        if self.enabled:
+            self.records.append(record)
+            _current_record.set(record)
+        return record
+
+    def summary(self):
+        phases = []
+        for record in self.records:
+            for phase in record.phases:
+                if phase not in phases:
+                    phases.append(phase)
+        return {
+            phase: summarize(
+                [
+                    record.phases[phase]
+                    for record in self.records
+                    if phase in record.phases
+                ]
+            )
+            for phase in phases
+        }
+
+
+async def _mark_send(request):
+    record = _current_record.get()
+    if record is None:
+        return
+    if "send" in record.phases:
+        # The client is retrying (e.g., after a 429), so the time since the last mark is
+        # the failed attempt plus the backoff, not the time spent preparing the request
+        record.mark("retry")
+    else:
+        record.mark("send")
+
+
+def phase_event_hooks():
+    """Event hooks for an httpx client that mark the end of the "send" phase.
+
+    Pass them to the OpenAI client with
+    `AsyncOpenAI(http_client=DefaultAsyncHttpxClient(event_hooks=phase_event_hooks()))`.
+    The hook fires right before the request goes out, so everything after it,
+    including waiting for a connection, counts as "await".
+    When the client retries a request, the failed attempts and the waits between them count as "retry".
+    """
+    return {"request": [_mark_send]}
+
+
+#######################################
+# Sampling profiler
+
+
+class SamplingProfiler:
+    """Sample the stack of one thread at a fixed interval and count how often each stack shows up.
+
+    Call it from the thread that runs the event loop.
+    The output uses the "collapsed stack" format (one `frame;frame;frame count` line per stack),
+    which can be turned into a flamegraph with tools like speedscope, inferno, or flamegraph.pl.
+    """
+
+    def __init__(self, output_path, interval=0.005):
+        self.output_path = output_path
+        self.interval = interval
+        self.stacks = Counter()
+        self._target_thread_id = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self._target_thread_id)
+            if frame is not None:
+                self.stacks[self._collapse(frame)] += 1
+
+    def start(self):
+        self._target_thread_id = threading.get_ident()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        with open(self.output_path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+#######################################
+# Report
+
+
+def print_diagnostics(lag_monitor=None, phase_timer=None, profiler=None):
+    if lag_monitor is not None:
+        lag = lag_monitor.summary()
+        print(
+            f"Event loop lag over {lag['count']} samples: "
+            f"mean {lag['mean'] * 1000:.1f} ms, p50 {lag['p50'] * 1000:.1f} ms, "
+            f"p95 {lag['p95'] * 1000:.1f} ms, max {lag['max'] * 1000:.1f} ms"
+        )
+    if phase_timer is not None and phase_timer.records:
+        print(
+            f"{'phase':<8} {'count':>6} {'mean ms':>9} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"
+        )
+        for phase, stats in phase_timer.summary().items():
+            print(
+                f"{phase:<8} {stats['count']:>6} {stats['mean'] * 1000:>9.1f} "
+                f"{stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} "
+                f"{stats['max'] * 1000:>9.1f}"
+            )
+    if profiler is not None:
+        print(
+            f"Profile with {sum(profiler.stacks.values())} samples written to {profiler.output_path}"
+        )
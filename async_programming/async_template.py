@@ -1,14 +1,23 @@
 """
 This script provides a template for how to use the OpenAI API in async programming and allows setting the number of concurrent requests and timeout.
 It also uses tqdm to show the progress of the requests.
+Optionally, it can report diagnostics (event loop lag, time spent in each phase of a request, and a sampling profile)
+to help you find out what limits the throughput, see `async_diagnostics.py`.
 
 Author: Kaicheng Yang <yang3kc@gmail.com>
 """
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import asyncio
 from pydantic import BaseModel, Field
 from tqdm.asyncio import tqdm_asyncio
+from async_diagnostics import (
+    EventLoopLagMonitor,
+    PhaseTimer,
+    SamplingProfiler,
+    phase_event_hooks,
+    print_diagnostics,
+)
 
 #######################################
 # Prompt-related
@@ -39,30 +48,68 @@ class Sentiment(BaseModel):
     explanation: str = Field(description="Explanation of the sentiment score.")
 
 
+# We pass the JSON schema directly instead of using `text_format`,
+# so the response is validated by our own code and the time it takes can be measured separately
+sentiment_json_schema = {
+    "type": "object",
+    "title": "Sentiment",
+    "required": ["score", "explanation"],
+    "properties": {
+        "score": {
+            "type": "number",
+            "title": "Score",
+            "description": "Sentiment score in the range of -1 to 1, where -1 means negative and 1 means positive.",
+        },
+        "explanation": {
+            "type": "string",
+            "title": "Explanation",
+            "description": "Explanation of the sentiment score.",
+        },
+    },
+    "additionalProperties": False,
+}
+
+
 #######################################
 # Let's define a function to process the text message
-async_client = AsyncOpenAI()
+# The event hooks let the phase timer know when a request is actually sent
+async_client = AsyncOpenAI(
+    http_client=DefaultAsyncHttpxClient(event_hooks=phase_event_hooks())
+)
 
 
-async def process_text_message_async(text_message, timeout_seconds=10):
+async def process_text_message_async(text_message, timeout_seconds=10, record=None):
     try:
         response = await asyncio.wait_for(
-            async_client.responses.parse(
+            async_client.responses.create(
                 model="gpt-4.1-mini",
                 temperature=0.0,
                 instructions=system_prompt,
                 input=user_instruction.format(text_message=text_message),
-                text_format=Sentiment,
+                text={
+                    "format": {
+                        "type": "json_schema",
+                        "name": "sentiment",
+                        "strict": True,
+                        "schema": sentiment_json_schema,
+                    }
+                },
             ),
             timeout=timeout_seconds,
         )
+        if record is not None:
+            record.mark("await")
 
-        senti_score_result = response.output_parsed
+        # Validate the output with the pydantic model
+        senti_score_result = Sentiment.model_validate_json(response.output_text)
         # Async programming won't maintain the order of the results, so we need to return a dictionary with the input text message as well
         result = {
             "text_message": text_message,
             "response": senti_score_result.model_dump(),
+            "total_tokens": response.usage.total_tokens,
         }
+        if record is not None:
+            record.mark("parse")
         return result
     except asyncio.TimeoutError:
         return f"Timeout for text message: {text_message}"
@@ -70,33 +117,67 @@ async def process_text_message_async(text_message, timeout_seconds=10):
         return f"Error for text message: {text_message}, error: {e}"
 
 
-async def async_main(text_messages, concurrent_tasks=3, timeout_seconds=10):
-    # Create tasks properly
-    tasks = []
-    for text_message in text_messages:
-        task = asyncio.create_task(
-            process_text_message_async(text_message, timeout_seconds=timeout_seconds)
-        )
-        tasks.append(task)
-
+async def async_main(
+    text_messages,
+    concurrent_tasks=3,
+    timeout_seconds=10,
+    diagnostics=False,
+    profile_output=None,
+):
     # Apply concurrency limit
     semaphore = asyncio.Semaphore(concurrent_tasks)
 
-    async def bounded_task(task):
-        async with semaphore:
-            return await task
+    # The timer does nothing unless diagnostics are turned on
+    phase_timer = PhaseTimer(enabled=diagnostics)
+    lag_monitor = EventLoopLagMonitor() if diagnostics else None
+    profiler = SamplingProfiler(profile_output) if profile_output else None
 
-    # Create bounded tasks
-    bounded_tasks = [bounded_task(task) for task in tasks]
+    # The semaphore has to be acquired before the request starts,
+    # otherwise all the requests would be sent at once
+    async def bounded_task(text_message):
+        record = phase_timer.start(text_message)
+        async with semaphore:
+            # Time spent waiting for a free slot
+            record.mark("queue")
+            return await process_text_message_async(
+                text_message, timeout_seconds=timeout_seconds, record=record
+            )
 
-    # Gather results with tqdm
-    async_results = await tqdm_asyncio.gather(*bounded_tasks)
+    # Create tasks properly
+    tasks = [
+        asyncio.create_task(bounded_task(text_message))
+        for text_message in text_messages
+    ]
+
+    if lag_monitor is not None:
+        lag_monitor.start()
+    if profiler is not None:
+        profiler.start()
+    try:
+        # Gather results with tqdm
+        async_results = await tqdm_asyncio.gather(*tasks)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if lag_monitor is not None:
+            await lag_monitor.stop()
+
+    if diagnostics or profiler is not None:
+        print_diagnostics(lag_monitor, phase_timer if diagnostics else None, profiler)
     return async_results
 
 
 if __name__ == "__main__":
+    # Set `diagnostics=True` to see the event loop lag and the time spent in each phase of the requests
+    # Set `profile_output` to a file name to also write a sampling profile that can be turned into a flamegraph
     async_results = asyncio.run(
-        async_main(text_messages, concurrent_tasks=3, timeout_seconds=10)
+        async_main(
+            text_messages,
+            concurrent_tasks=3,
+            timeout_seconds=10,
+            diagnostics=False,
+            profile_output=None,
+        )
     )
     for result in async_results:
         # Here we check if the result is an exception
@@ -0,0 +1,385 @@
+"""
+This script provides a template for processing text messages with a stage pipeline.
+Each step (read, render, query, validate, write) runs as its own stage with its own concurrency,
+and the stages are connected by bounded queues so that a slow stage applies backpressure to the ones before it.
+At the end, it reports the throughput and queue depth of every stage so you can see which one is the bottleneck.
+
+The sync, threading, and async templates in this folder can all be expressed as configurations of this pipeline,
+see `SYNC_CONFIG`, `THREADING_CONFIG`, and `ASYNC_CONFIG` below.
+
+Author: Kaicheng Yang <yang3kc@gmail.com>
+"""
+
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pydantic import BaseModel, Field
+import json
+import time
+
+#######################################
+# Prompt-related
+
+# Here assume we have multiple messages to process
+text_messages = [
+    "The service here is very good!",
+    "The service here is good.",
+    "The service here is ok.",
+    "The service here is not very good.",
+    "The service here is terrible!",
+]
+
+system_prompt = "You are an expert on sentiment analysis. Your job is to evaluate the sentiment of the given text message."
+
+user_instruction = """
+    Given the following text message: '{text_message}', please evaluate its sentiment by giving a score in the range of -1 to 1, where -1 means negative and 1 means positive.
+    Also explain why.
+    """
+
+
+#######################################
+# Here we define a pydantic model to validate the output
+class Sentiment(BaseModel):
+    score: float = Field(
+        description="Sentiment score in the range of -1 to 1, where -1 means negative and 1 means positive."
+    )
+    explanation: str = Field(description="Explanation of the sentiment score.")
+
+
+# The query stage only sends the request and returns the raw text.
+# Validation happens in its own stage, so we pass the JSON schema directly instead of using `text_format`.
+sentiment_json_schema = {
+    "type": "object",
+    "title": "Sentiment",
+    "required": ["score", "explanation"],
+    "properties": {
+        "score": {
+            "type": "number",
+            "title": "Score",
+            "description": "Sentiment score in the range of -1 to 1, where -1 means negative and 1 means positive.",
+        },
+        "explanation": {
+            "type": "string",
+            "title": "Explanation",
+            "description": "Explanation of the sentiment score.",
+        },
+    },
+    "additionalProperties": False,
+}
+
+request_parameters = {
+    "model": "gpt-4.1-mini",
+    "temperature": 0.0,
+    "instructions": system_prompt,
+    "text": {
+        "format": {
+            "type": "json_schema",
+            "name": "sentiment",
+            "strict": True,
+            "schema": sentiment_json_schema,
+        }
+    },
+}
+
+# The timeout is set on the clients, so it works for both the sync and async query stage
+client = OpenAI(timeout=10)
+async_client = AsyncOpenAI(timeout=10)
+
+
+#######################################
+# Stage functions
+# Every stage function takes an item (a dictionary) and returns the updated item.
+# Functions used in "process" mode must be defined at the top level of the module so they can be pickled.
+
+
+def read_text_message(item):
+    # In a real project, this is where you would load the message from a file or a database
+    item["text_message"] = item["text_message"].strip()
+    return item
+
+
+def render_prompt(item):
+    item["prompt"] = user_instruction.format(text_message=item["text_message"])
+    return item
+
+
+def query_api(item):
+    response = client.responses.create(input=item["prompt"], **request_parameters)
+    item["raw_output"] = response.output_text
+    return item
+
+
+async def query_api_async(item):
+    response = await async_client.responses.create(
+        input=item["prompt"], **request_parameters
+    )
+    item["raw_output"] = response.output_text
+    return item
+
+
+def validate_output(item):
+    item["response"] = Sentiment.model_validate_json(item["raw_output"]).model_dump()
+    return item
+
+
+def make_writer(output_file):
+    # The write stage should run with concurrency 1 so lines are never interleaved
+    def write_result(item):
+        keys = ("id", "text_message", "response", "error")
+        result = {key: item[key] for key in keys if key in item}
+        output_file.write(json.dumps(result) + "\n")
+        output_file.flush()
+        return item
+
+    return write_result
+
+
+#######################################
+# The pipeline engine
+
+# Used to tell the workers of the next stage that there is nothing left to process
+_END = object()
+
+
+class Stage:
+    """A step in the pipeline and the statistics collected while it runs.
+
+    `mode` decides where `func` runs:
+    - "async": `func` is a coroutine function and is awaited on the event loop
+    - "thread": `func` runs in a thread pool with `concurrency` threads
+    - "process": `func` runs in a process pool with `concurrency` processes, useful for CPU-heavy steps
+
+    Items that failed in an earlier stage skip `func`, unless `handles_errors` is True (e.g., for the write stage).
+    """
+
+    def __init__(
+        self, name, func, mode="thread", concurrency=1, handles_errors=False
+    ):
+        if mode not in ("async", "thread", "process"):
+            raise ValueError(
+                f"Unknown mode: {mode}, must be one of ('async', 'thread', 'process')"
+            )
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1, got {concurrency}")
+        self.name = name
+        self.func = func
+        self.mode = mode
+        self.concurrency = concurrency
+        self.handles_errors = handles_errors
+
+        self.n_processed = 0
+        self.n_errors = 0
+        self.busy_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.queue_depth_samples = []
+        self.queue_size = 0
+
+    async def _call(self, item, executor):
+        if self.mode == "async":
+            return await self.func(item)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.func, item)
+
+    async def _worker(self, in_queue, out_queue, executor):
+        while True:
+            item = await in_queue.get()
+            if item is _END:
+                return
+            # Items that failed in an earlier stage are passed along untouched,
+            # except to stages like the write stage that record them
+            if "error" not in item or self.handles_errors:
+                start_time = time.perf_counter()
+                try:
+                    item = await self._call(item, executor)
+                except Exception as e:
+                    item["error"] = f"{self.name}: {e}"
+                    self.n_errors += 1
+                self.busy_seconds += time.perf_counter() - start_time
+                self.n_processed += 1
+            await out_queue.put(item)
+
+    def report(self):
+        wall = self.wall_seconds
+        throughput = self.n_processed / wall if wall > 0 else 0.0
+        # Capacity is how many items per second the stage could handle if it never had to wait for input
+        capacity = (
+            self.n_processed * self.concurrency / self.busy_seconds
+            if self.busy_seconds > 0
+            else float("inf")
+        )
+        # Utilization close to 1 means all workers of the stage were busy during the whole run
+        utilization = self.busy_seconds / (wall * self.concurrency) if wall > 0 else 0.0
+        samples = self.queue_depth_samples or [0]
+        return {
+            "stage": self.name,
+            "mode": self.mode,
+            "concurrency": self.concurrency,
+            "processed": self.n_processed,
+            "errors": self.n_errors,
+            "throughput_per_second": throughput,
+            "capacity_per_second": capacity,
+            "utilization": utilization,
+            "mean_queue_depth": sum(samples) / len(samples),
+            "max_queue_depth": max(samples),
+            "queue_size": self.queue_size,
+        }
+
+
+async def run_pipeline(items, stages, queue_size=10, sample_interval=0.1):
+    """Push `items` through `stages` and return the items coming out of the last stage.
+
+    Each stage reads from its own bounded queue of `queue_size` items.
+    When a stage falls behind, its queue fills up and the stages before it wait, so memory use stays bounded.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+    results = []
+    executors = []
+    for stage in stages:
+        stage.queue_size = queue_size
+        if stage.mode == "thread":
+            executors.append(ThreadPoolExecutor(max_workers=stage.concurrency))
+        elif stage.mode == "process":
+            executors.append(ProcessPoolExecutor(max_workers=stage.concurrency))
+        else:
+            executors.append(None)
+
+    class _Collector:
+        # The last stage puts its output here; it is never full so it never blocks
+        async def put(self, item):
+            results.append(item)
+
+    async def feed():
+        for item in items:
+            await queues[0].put(item)
+        for _ in range(stages[0].concurrency):
+            await queues[0].put(_END)
+
+    async def run_stage(index, stage):
+        out_queue = queues[index + 1] if index + 1 < len(stages) else _Collector()
+        workers = [
+            asyncio.create_task(
+                stage._worker(queues[index], out_queue, executors[index])
+            )
+            for _ in range(stage.concurrency)
+        ]
+        await asyncio.gather(*workers)
+        # Only tell the next stage to stop once every worker of this stage is done
+        if index + 1 < len(stages):
+            for _ in range(stages[index + 1].concurrency):
+                await out_queue.put(_END)
+
+    async def sample_queue_depth():
+        while True:
+            for stage, queue in zip(stages, queues):
+                stage.queue_depth_samples.append(queue.qsize())
+            await asyncio.sleep(sample_interval)
+
+    sampler = asyncio.create_task(sample_queue_depth())
+    start_time = time.perf_counter()
+    try:
+        await asyncio.gather(
+            feed(), *[run_stage(index, stage) for index, stage in enumerate(stages)]
+        )
+    finally:
+        sampler.cancel()
+        for stage in stages:
+            stage.wall_seconds = time.perf_counter() - start_time
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False)
+    return results
+
+
+def print_pipeline_report(stages):
+    reports = [stage.report() for stage in stages]
+    print(
+        f"{'stage':<10} {'mode':<8} {'workers':>7} {'done':>6} {'errors':>6} "
+        f"{'items/s':>9} {'capacity/s':>10} {'util':>6} {'queue avg/max/size':>18}"
+    )
+    for report in reports:
+        print(
+            f"{report['stage']:<10} {report['mode']:<8} {report['concurrency']:>7} "
+            f"{report['processed']:>6} {report['errors']:>6} "
+            f"{report['throughput_per_second']:>9.2f} "
+            f"{report['capacity_per_second']:>10.2f} {report['utilization']:>6.0%} "
+            f"{report['mean_queue_depth']:>10.1f}/{report['max_queue_depth']}/{report['queue_size']}"
+        )
+    # The stage with the lowest capacity limits the whole pipeline, so it is the one to scale up.
+    # Its input queue is usually the one that stays full.
+    bottleneck = min(reports, key=lambda report: report["capacity_per_second"])
+    print(
+        f"Bottleneck: {bottleneck['stage']} "
+        f"({bottleneck['capacity_per_second']:.2f} items/s, consider increasing its concurrency)"
+    )
+
+
+#######################################
+# Configurations
+# Each configuration maps a stage name to (function, mode, concurrency).
+# The write stage is added when the pipeline is built because it needs the output file.
+
+# Every stage has a single worker, so only one request is in flight at a time like a plain for loop.
+# The stages still overlap across items: one message can be rendered while another one is being queried.
+SYNC_CONFIG = {
+    "read": (read_text_message, "thread", 1),
+    "render": (render_prompt, "thread", 1),
+    "query": (query_api, "thread", 1),
+    "validate": (validate_output, "thread", 1),
+}
+
+# Same as threading_template.py: the API calls run in 3 threads
+THREADING_CONFIG = {
+    "read": (read_text_message, "thread", 1),
+    "render": (render_prompt, "thread", 1),
+    "query": (query_api, "thread", 3),
+    "validate": (validate_output, "thread", 1),
+}
+
+# Same as async_template.py: up to 3 concurrent requests on the event loop,
+# while validation runs in a separate process so it never blocks the loop
+ASYNC_CONFIG = {
+    "read": (read_text_message, "thread", 1),
+    "render": (render_prompt, "thread", 1),
+    "query": (query_api_async, "async", 3),
+    "validate": (validate_output, "process", 1),
+}
+
+
+def build_stages(config, output_file):
+    stages = [
+        Stage(name, func, mode=mode, concurrency=concurrency)
+        for name, (func, mode, concurrency) in config.items()
+    ]
+    stages.append(
+        Stage(
+            "write",
+            make_writer(output_file),
+            mode="thread",
+            concurrency=1,
+            handles_errors=True,
+        )
+    )
+    return stages
+
+
+if __name__ == "__main__":
+    # Assign a unique ID to each message so the results can be merged back with the input
+    items = [
+        {"id": f"text_message_{index}", "text_message": text_message}
+        for index, text_message in enumerate(text_messages)
+    ]
+
+    with open("pipeline_results.jsonl", "w") as output_file:
+        stages = build_stages(ASYNC_CONFIG, output_file)
+        start_time = time.perf_counter()
+        pipeline_results = asyncio.run(run_pipeline(items, stages, queue_size=10))
+        end_time = time.perf_counter()
+
+    print(f"Pipeline done in {end_time - start_time:.2f} seconds.")
+    print_pipeline_report(stages)
+    for result in pipeline_results:
+        # You might need to re-try the failed requests later
+        if "error" in result:
+            print(f"Error: {result['error']}")
+        else:
+            print(result["response"])
@@ -0,0 +1,466 @@
+"""
+This script lets several jobs share the rate limits of the same API key without throttling each other.
+
+Each job registers with a coordinator backed by a small state file and a file lock, and asks for capacity before every request.
+The coordinator keeps a shared budget of requests and tokens per minute and hands it out by priority and weight:
+- Busy jobs share the capacity in proportion to their weights (weighted fair queuing).
+- Each priority level multiplies the weight by `PRIORITY_FACTOR`, so higher priorities get a larger share
+  but lower priorities are never starved.
+- A job that stops asking for capacity is considered idle, and its share goes to the jobs that are still busy.
+
+It relies on `fcntl`, so it works on Linux and macOS but not on Windows.
+
+Usage (run each job in its own terminal, the state file is shared):
+    python rate_limit_coordinator.py --job-id project_a --weight 2 --requests-per-minute 500 --tokens-per-minute 200000
+    python rate_limit_coordinator.py --job-id project_b --weight 1
+    python rate_limit_coordinator.py --report
+
+Author: Kaicheng Yang <yang3kc@gmail.com>
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_STATE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "llm_rate_limit_state.json"
+)
+
+# Used when the state file is created by a job that doesn't pass its own limits.
+# Set them to the limits of your organization, see https://platform.openai.com/settings/organization/limits
+DEFAULT_LIMITS = {"requests_per_minute": 500, "tokens_per_minute": 200_000}
+
+# Finished jobs (and jobs that crashed without unregistering) are removed from the state file after this many seconds,
+# otherwise every run with the default job ID would stay in it forever
+JOB_RETENTION = 24 * 60 * 60
+
+# A job with priority 1 gets 4 times the share of a job with the same weight and priority 0
+PRIORITY_FACTOR = 4
+
+
+def estimate_tokens(text, expected_output_tokens=300):
+    # A rough estimate (about 4 characters per token) is good enough for reserving capacity,
+    # call `record_usage` with the actual number once the response arrives
+    return len(text) // 4 + expected_output_tokens
+
+
+class RateLimitCoordinator:
+    """Share `requests_per_minute` and `tokens_per_minute` between the jobs using the same `state_path`.
+
+    All jobs use the limits stored in the state file.
+    If a job passes limits that differ from the stored ones, they replace them when it registers (with a warning);
+    if it passes None, it uses the stored limits (or the defaults if there are none yet).
+    Call `acquire` (or `acquire_async`) with the estimated number of tokens before every request.
+    """
+
+    def __init__(
+        self,
+        job_id,
+        state_path=DEFAULT_STATE_PATH,
+        weight=1.0,
+        priority=0,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        idle_timeout=5.0,
+        poll_interval=0.05,
+        contention_window=1.0,
+        job_retention=JOB_RETENTION,
+    ):
+        if weight <= 0:
+            raise ValueError(f"Weight must be positive, got {weight}")
+        self.job_id = job_id
+        self.state_path = state_path
+        self.lock_path = state_path + ".lock"
+        self.weight = weight
+        self.priority = priority
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.contention_window = contention_window
+        self.job_retention = job_retention
+        # A waiting job only needs to refresh `last_seen` often enough to stay within the contention window,
+        # so most of its unsuccessful polls don't change the state file at all
+        self.heartbeat_interval = contention_window / 4
+        # The coroutines of this job waiting for capacity, served in order by a single poller
+        self._waiters = deque()
+        self._poller = None
+
+    #######################################
+    # Shared state
+
+    @contextmanager
+    def _locked_state(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.state_path):
+                    with open(self.state_path) as f:
+                        original = f.read()
+                    state = json.loads(original)
+                else:
+                    original = None
+                    state = self._new_state()
+                yield state
+                # Most calls are polls that find it isn't their turn yet, skip the write if nothing changed
+                updated = json.dumps(state)
+                if updated != original:
+                    # Write to a temporary file first so a crash never leaves a half-written state
+                    temp_path = self.state_path + ".tmp"
+                    with open(temp_path, "w") as f:
+                        f.write(updated)
+                    os.replace(temp_path, self.state_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _new_state(self):
+        limits = dict(DEFAULT_LIMITS)
+        if self.requests_per_minute is not None:
+            limits["requests_per_minute"] = self.requests_per_minute
+        if self.tokens_per_minute is not None:
+            limits["tokens_per_minute"] = self.tokens_per_minute
+        return {
+            "limits": limits,
+            "bucket": {
+                "requests": float(limits["requests_per_minute"]),
+                "tokens": float(limits["tokens_per_minute"]),
+                "updated": time.time(),
+            },
+            "jobs": {},
+        }
+
+    def _update_limits(self, state):
+        limits = state["limits"]
+        for name, value in (
+            ("requests_per_minute", self.requests_per_minute),
+            ("tokens_per_minute", self.tokens_per_minute),
+        ):
+            if value is not None and value != limits[name]:
+                print(
+                    f"Warning: changing {name} shared by all jobs from {limits[name]} to {value}"
+                )
+                limits[name] = value
+                # Don't let the bucket hold more than the new limit
+                bucket_key = "requests" if name == "requests_per_minute" else "tokens"
+                state["bucket"][bucket_key] = min(state["bucket"][bucket_key], value)
+
+    def _refilled_bucket(self, state, now):
+        # Return the bucket as it is at `now` without changing the state,
+        # the refill only needs to be saved when something is taken from the bucket
+        limits = state["limits"]
+        bucket = state["bucket"]
+        elapsed = max(0.0, now - bucket["updated"])
+        return {
+            "requests": min(
+                limits["requests_per_minute"],
+                bucket["requests"] + elapsed * limits["requests_per_minute"] / 60,
+            ),
+            "tokens": min(
+                limits["tokens_per_minute"],
+                bucket["tokens"] + elapsed * limits["tokens_per_minute"] / 60,
+            ),
+            "updated": now,
+        }
+
+    def _active_jobs(self, state, now):
+        return {
+            job_id: job
+            for job_id, job in state["jobs"].items()
+            if now - job["last_seen"] <= self.idle_timeout and not job.get("finished")
+        }
+
+    def _prune_jobs(self, state, now):
+        state["jobs"] = {
+            job_id: job
+            for job_id, job in state["jobs"].items()
+            if now - (job.get("finished") or job["last_seen"]) <= self.job_retention
+        }
+
+    #######################################
+    # Registration
+
+    def register(self):
+        now = time.time()
+        with self._locked_state() as state:
+            self._update_limits(state)
+            self._prune_jobs(state, now)
+            active_jobs = self._active_jobs(state, now)
+            job = state["jobs"].setdefault(self.job_id, {"virtual_time": 0.0})
+            # Every run starts a new accounting window, so the report shows the current run only
+            job.update(
+                {
+                    "requests": 0,
+                    "tokens": 0,
+                    "registered": now,
+                    "weight": self.weight,
+                    "priority": self.priority,
+                    "pid": os.getpid(),
+                    "last_seen": now,
+                    "waiting_since": None,
+                    "finished": None,
+                }
+            )
+            self._catch_up(job, active_jobs)
+
+    def unregister(self):
+        # The job is kept in the state file for `job_retention` seconds so its throughput still shows up in the report
+        with self._locked_state() as state:
+            job = state["jobs"].get(self.job_id)
+            if job is not None:
+                job["waiting_since"] = None
+                job["finished"] = time.time()
+
+    def _catch_up(self, job, active_jobs):
+        # A job that was idle shouldn't be able to claim the capacity it didn't use,
+        # so it starts from where the least-served active job is
+        others = [
+            other["virtual_time"]
+            for job_id, other in active_jobs.items()
+            if job_id != self.job_id
+        ]
+        if others:
+            job["virtual_time"] = max(job["virtual_time"], min(others))
+
+    #######################################
+    # Acquire capacity
+
+    def try_acquire(self, tokens):
+        """Take one request and `tokens` tokens from the shared budget if it is this job's turn."""
+        now = time.time()
+        with self._locked_state() as state:
+            active_jobs = self._active_jobs(state, now)
+            job = state["jobs"].get(self.job_id)
+            if job is None:
+                raise RuntimeError(f"Job {self.job_id} is not registered")
+            if self.job_id not in active_jobs:
+                self._catch_up(job, active_jobs)
+            if job["waiting_since"] is None:
+                job["waiting_since"] = now
+                job["last_seen"] = now
+            elif now - job["last_seen"] >= self.heartbeat_interval:
+                job["last_seen"] = now
+
+            # Only jobs that are waiting right now compete, idle jobs leave their share to the others.
+            # A waiting job refreshes `last_seen` every `heartbeat_interval`, so one that stopped has crashed or given up.
+            contenders = {
+                job_id: other
+                for job_id, other in active_jobs.items()
+                if other["waiting_since"] is not None
+                and now - other["last_seen"] <= self.contention_window
+            }
+            contenders[self.job_id] = job
+            next_job_id = min(
+                contenders,
+                key=lambda job_id: (contenders[job_id]["virtual_time"], job_id),
+            )
+            if next_job_id != self.job_id:
+                return False
+
+            bucket = self._refilled_bucket(state, now)
+            limits = state["limits"]
+            # A single request larger than the whole token budget would never fit, so cap it
+            tokens = min(tokens, limits["tokens_per_minute"])
+            if bucket["requests"] < 1 or bucket["tokens"] < tokens:
+                return False
+
+            bucket["requests"] -= 1
+            bucket["tokens"] -= tokens
+            state["bucket"] = bucket
+            # The cost of a request is its share of whichever limit it uses up the most
+            cost = max(
+                1 / limits["requests_per_minute"], tokens / limits["tokens_per_minute"]
+            )
+            share = job["weight"] * PRIORITY_FACTOR ** job["priority"]
+            job["virtual_time"] += cost / share
+            job["requests"] += 1
+            job["tokens"] += tokens
+            job["last_seen"] = now
+            job["waiting_since"] = None
+            return True
+
+    def acquire(self, tokens):
+        while not self.try_acquire(tokens):
+            time.sleep(self.poll_interval)
+
+    async def acquire_async(self, tokens):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((tokens, future))
+        # One poller per job hands the capacity to the waiting coroutines in order,
+        # instead of every coroutine polling the state file from its own thread
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._serve_waiters())
+        await future
+
+    async def _serve_waiters(self):
+        while self._waiters:
+            tokens, future = self._waiters[0]
+            if future.cancelled():
+                self._waiters.popleft()
+                continue
+            try:
+                # The file lock blocks, so take it in a thread to keep the event loop free
+                granted = await asyncio.to_thread(self.try_acquire, tokens)
+            except Exception as e:
+                while self._waiters:
+                    _, future = self._waiters.popleft()
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            if granted:
+                self._waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+            else:
+                await asyncio.sleep(self.poll_interval)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Correct the budget once the actual number of tokens of a request is known."""
+        with self._locked_state() as state:
+            difference = actual_tokens - estimated_tokens
+            bucket = self._refilled_bucket(state, time.time())
+            # Tokens given back can't fill the bucket beyond the limit
+            bucket["tokens"] = min(
+                state["limits"]["tokens_per_minute"], bucket["tokens"] - difference
+            )
+            state["bucket"] = bucket
+            job = state["jobs"].get(self.job_id)
+            if job is not None:
+                job["tokens"] += difference
+
+
+#######################################
+# Report
+
+
+def job_report(state_path=DEFAULT_STATE_PATH, idle_timeout=5.0):
+    """Return the limits and the throughput of each job, or `(None, [])` if no job has registered yet."""
+    if not os.path.exists(state_path):
+        return None, []
+    with open(state_path) as f:
+        state = json.load(f)
+    now = time.time()
+    report = []
+    for job_id, job in state["jobs"].items():
+        # Measure the rate over the current run only, not the time since the run finished
+        end = job.get("finished") or job["last_seen"]
+        minutes = max(end - job["registered"], 1e-9) / 60
+        report.append(
+            {
+                "job_id": job_id,
+                "priority": job["priority"],
+                "weight": job["weight"],
+                "active": now - job["last_seen"] <= idle_timeout
+                and not job.get("finished"),
+                "requests": job["requests"],
+                "tokens": job["tokens"],
+                "requests_per_minute": job["requests"] / minutes,
+                "tokens_per_minute": job["tokens"] / minutes,
+            }
+        )
+    return state["limits"], report
+
+
+def print_job_report(state_path=DEFAULT_STATE_PATH):
+    limits, report = job_report(state_path)
+    if limits is None:
+        print(f"No job has registered with {state_path} yet")
+        return
+    print(
+        f"Limits: {limits['requests_per_minute']} requests/min, "
+        f"{limits['tokens_per_minute']} tokens/min"
+    )
+    print(
+        f"{'job':<20} {'prio':>4} {'weight':>6} {'active':>6} "
+        f"{'requests':>8} {'req/min':>9} {'tokens/min':>11}"
+    )
+    for job in report:
+        print(
+            f"{job['job_id']:<20} {job['priority']:>4} {job['weight']:>6.1f} "
+            f"{'yes' if job['active'] else 'no':>6} {job['requests']:>8} "
+            f"{job['requests_per_minute']:>9.1f} {job['tokens_per_minute']:>11.0f}"
+        )
+
+
+#######################################
+# Example job
+# This is the async template with one change: every request first asks the coordinator for capacity
+# and reports the tokens it actually used afterwards
+
+
+async def run_job(coordinator, text_messages, concurrent_tasks=3, timeout_seconds=10):
+    # Imported here so `--report` works without an API key
+    from async_template import process_text_message_async, user_instruction
+    from tqdm.asyncio import tqdm_asyncio
+
+    semaphore = asyncio.Semaphore(concurrent_tasks)
+
+    async def bounded_task(text_message):
+        async with semaphore:
+            estimated_tokens = estimate_tokens(
+                user_instruction.format(text_message=text_message)
+            )
+            await coordinator.acquire_async(estimated_tokens)
+            result = await process_text_message_async(
+                text_message, timeout_seconds=timeout_seconds
+            )
+            # Failed requests don't report their usage, so the estimate stays charged
+            if isinstance(result, dict):
+                await asyncio.to_thread(
+                    coordinator.record_usage, estimated_tokens, result["total_tokens"]
+                )
+            return result
+
+    return await tqdm_asyncio.gather(
+        *[bounded_task(text_message) for text_message in text_messages]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a job that shares the API rate limits with other jobs."
+    )
+    parser.add_argument("--job-id", default=f"job_{os.getpid()}")
+    parser.add_argument("--weight", type=float, default=1.0)
+    parser.add_argument("--priority", type=int, default=0)
+    parser.add_argument("--state-path", default=DEFAULT_STATE_PATH)
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        help="Request limit shared by all jobs (default: the limit already stored in the state file)",
+    )
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=int,
+        help="Token limit shared by all jobs (default: the limit already stored in the state file)",
+    )
+    parser.add_argument(
+        "--report", action="store_true", help="Print the throughput of each job and exit"
+    )
+    args = parser.parse_args()
+
+    if args.report:
+        print_job_report(args.state_path)
+    else:
+        from async_template import text_messages
+
+        coordinator = RateLimitCoordinator(
+            args.job_id,
+            state_path=args.state_path,
+            weight=args.weight,
+            priority=args.priority,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+        )
+        coordinator.register()
+        try:
+            async_results = asyncio.run(run_job(coordinator, text_messages))
+        finally:
+            coordinator.unregister()
+        for result in async_results:
+            print(result)
@@ -0,0 +1,317 @@
+"""
+This script builds an index of `custom_id -> (byte offset, length)` for batch input/output JSONL files,
+so a single record (or any subset) can be fetched without reading and parsing the whole file.
+
+The index is stored in a compact sidecar file next to the data file (e.g., `text_message_tasks.jsonl.idx`).
+It is a hash table of fixed-size slots, and both the index and the data file are memory-mapped,
+so a lookup only touches a few slots and the record itself.
+
+Usage:
+    python batch_index.py build text_message_tasks.jsonl openai_text_message_batch_output.jsonl
+    python batch_index.py get openai_text_message_batch_output.jsonl text_message_0 text_message_3
+    python batch_index.py missing text_message_tasks.jsonl openai_text_message_batch_output.jsonl
+    python batch_index.py join text_message_tasks.jsonl openai_text_message_batch_output.jsonl joined.jsonl
+
+Author: Kaicheng Yang <yang3kc@gmail.com>
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+
+#######################################
+# Index file format
+# Header: magic, size and modification time of the data file, number of records, number of slots
+# Slots: hash of the custom_id, byte offset of the record, length of the record (0 means the slot is empty)
+INDEX_MAGIC = b"CIDIDX01"
+HEADER = struct.Struct("<8sQdQQ")
+SLOT = struct.Struct("<QQI")
+
+# The custom_id comes before the prompt and the response in both files
+# (it is the first key in the task records and follows "id" in the output records).
+# Quotes inside JSON strings are escaped, so this can't match text inside the prompt or the response.
+CUSTOM_ID_PATTERN = re.compile(rb'"custom_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def index_path_for(data_path):
+    return data_path + ".idx"
+
+
+def hash_custom_id(custom_id):
+    return int.from_bytes(
+        hashlib.blake2b(custom_id.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def extract_custom_id(record):
+    match = CUSTOM_ID_PATTERN.search(record)
+    if match is not None:
+        return json.loads(b'"' + match.group(1) + b'"')
+    # Fall back to parsing the whole record if it doesn't look like we expect
+    return json.loads(record)["custom_id"]
+
+
+#######################################
+# Build the index
+
+
+def build_index(data_path):
+    """Scan `data_path` once and write its index to `data_path + ".idx"`."""
+    entries = []
+    n_duplicates = 0
+    seen = set()
+    with open(data_path, "rb") as f:
+        offset = 0
+        for line in f:
+            record = line.rstrip(b"\r\n")
+            if record.strip():
+                custom_id = extract_custom_id(record)
+                if custom_id in seen:
+                    n_duplicates += 1
+                else:
+                    seen.add(custom_id)
+                    entries.append((hash_custom_id(custom_id), offset, len(record)))
+            offset += len(line)
+
+    if n_duplicates:
+        print(
+            f"Warning: {n_duplicates} duplicate custom_id(s) in {data_path}, only the first one is indexed"
+        )
+
+    # Keep the table at most half full so that lookups only need to probe a few slots
+    n_slots = 1
+    while n_slots < 2 * len(entries):
+        n_slots *= 2
+    slots = [None] * n_slots
+    for entry in entries:
+        position = entry[0] & (n_slots - 1)
+        while slots[position] is not None:
+            position = (position + 1) & (n_slots - 1)
+        slots[position] = entry
+
+    stat = os.stat(data_path)
+    with open(index_path_for(data_path), "wb") as f:
+        f.write(
+            HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime, len(entries), n_slots)
+        )
+        empty_slot = SLOT.pack(0, 0, 0)
+        for slot in slots:
+            f.write(empty_slot if slot is None else SLOT.pack(*slot))
+    return len(entries)
+
+
+#######################################
+# Look up records
+
+
+class BatchIndex:
+    """Memory-mapped view of a JSONL file and its custom_id index.
+
+    Use it as a context manager:
+
+        with BatchIndex.open("openai_text_message_batch_output.jsonl") as output_index:
+            record = output_index.get("text_message_0")
+    """
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        with open(index_path_for(data_path), "rb") as f:
+            # mmap can't map an empty file, and a truncated file doesn't have a full header
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise ValueError(f"{index_path_for(data_path)} is truncated")
+            self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, data_size, data_mtime, self.n_records, self.n_slots = (
+            HEADER.unpack_from(self._index_map, 0)
+        )
+        expected_size = HEADER.size + self.n_slots * SLOT.size
+        if magic != INDEX_MAGIC or len(self._index_map) != expected_size:
+            self._index_map.close()
+            raise ValueError(
+                f"{index_path_for(data_path)} is not a valid custom_id index"
+            )
+        stat = os.stat(data_path)
+        if stat.st_size != data_size or stat.st_mtime != data_mtime:
+            self._index_map.close()
+            raise ValueError(
+                f"The index of {data_path} is out of date, rebuild it with `build_index`"
+            )
+        # mmap can't map an empty file
+        self._data_file = open(data_path, "rb")
+        self._data_map = (
+            mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if data_size
+            else b""
+        )
+
+    @classmethod
+    def open(cls, data_path, rebuild=True):
+        """Open the index of `data_path`, (re)building it first if it is missing or out of date."""
+        try:
+            return cls(data_path)
+        except (FileNotFoundError, ValueError):
+            if not rebuild:
+                raise
+        build_index(data_path)
+        return cls(data_path)
+
+    def close(self):
+        self._index_map.close()
+        if isinstance(self._data_map, mmap.mmap):
+            self._data_map.close()
+        self._data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.n_records
+
+    def _slot(self, position):
+        return SLOT.unpack_from(self._index_map, HEADER.size + position * SLOT.size)
+
+    def _slots_for_hash(self, key_hash):
+        position = key_hash & (self.n_slots - 1)
+        while True:
+            slot_hash, offset, length = self._slot(position)
+            if length == 0:
+                return
+            if slot_hash == key_hash:
+                yield offset, length
+            position = (position + 1) & (self.n_slots - 1)
+
+    def locate(self, custom_id):
+        """Return `(offset, length)` of the record with `custom_id`, or None if it isn't in the file."""
+        for offset, length in self._slots_for_hash(hash_custom_id(custom_id)):
+            # Check the record itself in case two custom_ids have the same hash
+            if extract_custom_id(self.record_at(offset, length)) == custom_id:
+                return offset, length
+        return None
+
+    def __contains__(self, custom_id):
+        return self.locate(custom_id) is not None
+
+    def get_raw(self, custom_id):
+        location = self.locate(custom_id)
+        if location is None:
+            return None
+        return self.record_at(*location)
+
+    def get(self, custom_id):
+        """Return the parsed record with `custom_id`, or None if it isn't in the file."""
+        record = self.get_raw(custom_id)
+        return None if record is None else json.loads(record)
+
+    def get_many(self, custom_ids):
+        return {custom_id: self.get(custom_id) for custom_id in custom_ids}
+
+    def entries(self):
+        """Return `(hash, offset, length)` for every record, in the order they appear in the file."""
+        occupied = []
+        for position in range(self.n_slots):
+            slot = self._slot(position)
+            if slot[2] != 0:
+                occupied.append(slot)
+        # Reading the records in file order is much faster than jumping around a large file
+        occupied.sort(key=lambda slot: slot[1])
+        return occupied
+
+    def record_at(self, offset, length):
+        return self._data_map[offset : offset + length]
+
+    def has_hash(self, key_hash):
+        return next(self._slots_for_hash(key_hash), None) is not None
+
+
+#######################################
+# Tools built on top of the index
+
+
+def find_missing(tasks_path, output_path):
+    """Return the custom_ids in the task file that don't have a result in the output file."""
+    with BatchIndex.open(tasks_path) as task_index, BatchIndex.open(
+        output_path
+    ) as output_index:
+        missing = []
+        for key_hash, offset, length in task_index.entries():
+            # Comparing hashes is enough here, only the missing records are read
+            if not output_index.has_hash(key_hash):
+                missing.append(extract_custom_id(task_index.record_at(offset, length)))
+        return missing
+
+
+def join_tasks_and_outputs(tasks_path, output_path):
+    """Yield `(custom_id, task, output)` for every task, with `output` None if there is no result."""
+    with BatchIndex.open(tasks_path) as task_index, BatchIndex.open(
+        output_path
+    ) as output_index:
+        for _, offset, length in task_index.entries():
+            record = task_index.record_at(offset, length)
+            custom_id = extract_custom_id(record)
+            yield custom_id, json.loads(record), output_index.get(custom_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index batch JSONL files by custom_id and look up records."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build or rebuild the index")
+    build_parser.add_argument("files", nargs="+")
+
+    get_parser = subparsers.add_parser("get", help="Print the records with the given custom_ids")
+    get_parser.add_argument("file")
+    get_parser.add_argument("custom_ids", nargs="+")
+
+    missing_parser = subparsers.add_parser(
+        "missing", help="Print the custom_ids of the tasks without a result"
+    )
+    missing_parser.add_argument("tasks_file")
+    missing_parser.add_argument("output_file")
+
+    join_parser = subparsers.add_parser(
+        "join", help="Write each task together with its result to a JSONL file"
+    )
+    join_parser.add_argument("tasks_file")
+    join_parser.add_argument("output_file")
+    join_parser.add_argument("joined_file")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for data_path in args.files:
+            n_records = build_index(data_path)
+            print(f"Indexed {n_records} records in {data_path}")
+    elif args.command == "get":
+        with BatchIndex.open(args.file) as index:
+            for custom_id in args.custom_ids:
+                record = index.get_raw(custom_id)
+                if record is None:
+                    print(f"Not found: {custom_id}")
+                else:
+                    print(record.decode("utf-8"))
+    elif args.command == "missing":
+        missing = find_missing(args.tasks_file, args.output_file)
+        for custom_id in missing:
+            print(custom_id)
+        print(f"{len(missing)} task(s) without a result")
+    elif args.command == "join":
+        with open(args.joined_file, "w") as f:
+            for custom_id, task, output in join_tasks_and_outputs(
+                args.tasks_file, args.output_file
+            ):
+                f.write(
+                    json.dumps({"custom_id": custom_id, "task": task, "output": output})
+                    + "\n"
+                )
+
+
+if __name__ == "__main__":
+    main()
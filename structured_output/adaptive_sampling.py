@@ -0,0 +1,215 @@
+"""
+This script demonstrates how to query each text message several times (or with several models) and aggregate the scores,
+without paying N times the cost for every message.
+
+The samples are sent in waves.
+After each wave, a message stops receiving new samples once its scores agree within a tolerance
+or the confidence interval of the mean score is narrow enough.
+Only the ambiguous messages get more samples, so the total number of calls stays close to one per message when most of them are easy.
+
+Author: Kaicheng Yang <yang3kc@gmail.com>
+"""
+
+from openai import OpenAI
+from pydantic import BaseModel, Field
+import math
+import statistics
+from tqdm.contrib.concurrent import thread_map
+
+#######################################
+# Prompt-related
+
+# Here assume we have multiple messages to process
+text_messages = [
+    "The service here is very good!",
+    "The service here is good.",
+    "The service here is ok.",
+    "The service here is not very good.",
+    "The service here is terrible!",
+]
+
+system_prompt = "You are an expert on sentiment analysis. Your job is to evaluate the sentiment of the given text message."
+
+user_instruction = """
+    Given the following text message: '{text_message}', please evaluate its sentiment by giving a score in the range of -1 to 1, where -1 means negative and 1 means positive.
+    Also explain why.
+    """
+
+
+#######################################
+# Here we define a pydantic model to validate the output
+class Sentiment(BaseModel):
+    score: float = Field(
+        description="Sentiment score in the range of -1 to 1, where -1 means negative and 1 means positive."
+    )
+    explanation: str = Field(description="Explanation of the sentiment score.")
+
+
+#######################################
+# Query the API
+client = OpenAI()
+
+
+def query_sentiment_score(text_message, model, temperature):
+    try:
+        response = client.responses.parse(
+            model=model,
+            temperature=temperature,
+            instructions=system_prompt,
+            input=user_instruction.format(text_message=text_message),
+            text_format=Sentiment,
+        )
+        return response.output_parsed.score
+    except Exception as e:
+        # A failed sample is simply not counted, the message can get another one in the next wave
+        print(f"Error for text message: {text_message}, error: {e}")
+        return None
+
+
+#######################################
+# Aggregation and stopping rules
+
+
+# Two-sided 95% quantiles of the t distribution for 1 to 30 degrees of freedom.
+# With only a few samples, the normal quantile (1.96) would make the interval far too narrow.
+T_QUANTILES_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]  # fmt: skip
+
+
+def agreement_stats(scores):
+    n_samples = len(scores)
+    std = statistics.stdev(scores) if n_samples > 1 else 0.0
+    degrees_of_freedom = n_samples - 1
+    t = (
+        T_QUANTILES_95[degrees_of_freedom - 1]
+        if degrees_of_freedom <= len(T_QUANTILES_95)
+        else 1.96
+    )
+    return {
+        "score": statistics.fmean(scores),
+        "median_score": statistics.median(scores),
+        "n_samples": n_samples,
+        "std": std,
+        "spread": max(scores) - min(scores),
+        # Half width of the 95% confidence interval of the mean score
+        "ci_half_width": t * std / math.sqrt(n_samples) if n_samples > 1 else None,
+    }
+
+
+def stop_reason(scores, tolerance, ci_half_width, confident_score, min_samples=1):
+    """Return why a message needs no more samples, or None if it does."""
+    if len(scores) < min_samples:
+        return None
+    if len(scores) == 1:
+        # A single answer can't show agreement, but a clearly positive or negative score is rarely ambiguous
+        if confident_score is not None and abs(scores[0]) >= confident_score:
+            return "confident"
+        return None
+    stats = agreement_stats(scores)
+    # Scores are usually on a 0.1 grid, and e.g. 0.4 - 0.3 is slightly above 0.1 in floating point
+    if stats["spread"] <= tolerance + 1e-9:
+        return "agreement"
+    if stats["ci_half_width"] <= ci_half_width:
+        return "confidence_bound"
+    return None
+
+
+def annotate_adaptively(
+    text_messages,
+    models=("gpt-4.1-mini",),
+    temperature=1.0,
+    initial_samples=1,
+    wave_size=2,
+    max_samples=5,
+    tolerance=0.1,
+    ci_half_width=0.1,
+    confident_score=0.8,
+    n_threads=3,
+):
+    """Sample each message in waves until its scores agree or `max_samples` is reached.
+
+    The samples of a message cycle through `models`, so passing several models gives a multi-model vote.
+    With a single model, use a temperature above 0, otherwise all samples will be the same.
+    Set `confident_score` to None to always require at least two agreeing samples.
+    With several models, `confident_score` is ignored and no message stops before every model has answered,
+    so that every model gets a vote.
+    """
+    if max_samples < len(models):
+        raise ValueError(
+            f"max_samples ({max_samples}) must be at least the number of models ({len(models)})"
+        )
+    min_samples = 1
+    if len(models) > 1:
+        confident_score = None
+        min_samples = len(models)
+        # Ask every model in the first wave instead of waiting for several waves
+        initial_samples = max(initial_samples, len(models))
+    scores = [[] for _ in text_messages]
+    n_calls = [0 for _ in text_messages]
+    reasons = [None for _ in text_messages]
+    active = list(range(len(text_messages)))
+
+    wave = 0
+    while active:
+        wave += 1
+        samples_per_item = initial_samples if wave == 1 else wave_size
+        jobs = []
+        for index in active:
+            n_new = min(samples_per_item, max_samples - n_calls[index])
+            for _ in range(n_new):
+                model = models[n_calls[index] % len(models)]
+                jobs.append((index, model))
+                n_calls[index] += 1
+
+        wave_scores = thread_map(
+            lambda job: query_sentiment_score(
+                text_messages[job[0]], job[1], temperature
+            ),
+            jobs,
+            max_workers=n_threads,
+            desc=f"Wave {wave} ({len(active)} messages)",
+        )
+        for (index, _), score in zip(jobs, wave_scores):
+            if score is not None:
+                scores[index].append(score)
+
+        still_active = []
+        for index in active:
+            reason = stop_reason(
+                scores[index], tolerance, ci_half_width, confident_score, min_samples
+            )
+            if reason is None and n_calls[index] >= max_samples:
+                reason = "max_samples"
+            if reason is None:
+                still_active.append(index)
+            else:
+                reasons[index] = reason
+        active = still_active
+
+    results = []
+    for index, text_message in enumerate(text_messages):
+        result = {"text_message": text_message, "n_calls": n_calls[index]}
+        if scores[index]:
+            result.update(agreement_stats(scores[index]))
+        result["stop_reason"] = reasons[index]
+        result["scores"] = scores[index]
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    max_samples = 5
+    results = annotate_adaptively(text_messages, max_samples=max_samples)
+
+    for result in results:
+        print(result)
+
+    total_calls = sum(result["n_calls"] for result in results)
+    print(
+        f"Total calls: {total_calls} for {len(results)} messages "
+        f"({total_calls / len(results):.2f} per message, "
+        f"compared to {max_samples} per message with a fixed number of samples)"
+    )
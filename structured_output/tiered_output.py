@@ -0,0 +1,255 @@
+"""
+This script demonstrates how to save output tokens by asking for explanations only when they are needed.
+
+Most of the output tokens (and therefore most of the latency and cost) go to the free-text explanation.
+So we run the whole dataset with a score-only schema and a small `max_output_tokens` first,
+then run a second pass with explanations on a subset of messages chosen by a rule (borderline scores and a random sample).
+The two passes are merged by ID, and the token savings are reported.
+
+Author: Kaicheng Yang <yang3kc@gmail.com>
+"""
+
+from openai import OpenAI
+from pydantic import BaseModel, Field, ValidationError
+import random
+from tqdm.contrib.concurrent import thread_map
+
+#######################################
+# Prompt-related
+
+# Here assume we have multiple messages to process
+text_messages = [
+    "The service here is very good!",
+    "The service here is good.",
+    "The service here is ok.",
+    "The service here is not very good.",
+    "The service here is terrible!",
+]
+
+system_prompt = "You are an expert on sentiment analysis. Your job is to evaluate the sentiment of the given text message."
+
+# The score-only pass shouldn't ask for an explanation in the prompt either
+score_instruction = """
+    Given the following text message: '{text_message}', please evaluate its sentiment by giving a score in the range of -1 to 1, where -1 means negative and 1 means positive.
+    """
+
+user_instruction = """
+    Given the following text message: '{text_message}', please evaluate its sentiment by giving a score in the range of -1 to 1, where -1 means negative and 1 means positive.
+    Also explain why.
+    """
+
+
+#######################################
+# Here we define the pydantic models for the two tiers
+class SentimentScore(BaseModel):
+    score: float = Field(
+        description="Sentiment score in the range of -1 to 1, where -1 means negative and 1 means positive."
+    )
+
+
+class Sentiment(BaseModel):
+    score: float = Field(
+        description="Sentiment score in the range of -1 to 1, where -1 means negative and 1 means positive."
+    )
+    explanation: str = Field(description="Explanation of the sentiment score.")
+
+
+def strict_json_schema(model):
+    # Strict structured output requires every object to forbid extra keys
+    schema = model.model_json_schema()
+    schema["additionalProperties"] = False
+    return schema
+
+
+# Each tier has its own schema, prompt, and output token limit
+# A score fits in a handful of tokens; 16 is the smallest limit the API accepts
+tiers = {
+    "score": {
+        "text_format": SentimentScore,
+        "instruction": score_instruction,
+        "max_output_tokens": 16,
+    },
+    "explanation": {
+        "text_format": Sentiment,
+        "instruction": user_instruction,
+        "max_output_tokens": 300,
+    },
+}
+
+
+#######################################
+# Query the API
+client = OpenAI()
+
+
+def process_text_message(item, tier):
+    tier_config = tiers[tier]
+    result = {"id": item["id"], "tier": tier}
+    # We validate the output ourselves instead of using `responses.parse`,
+    # so the tokens of truncated or invalid outputs are still counted
+    try:
+        response = client.responses.create(
+            model="gpt-4.1-mini",
+            temperature=0.0,
+            instructions=system_prompt,
+            input=tier_config["instruction"].format(text_message=item["text_message"]),
+            text={
+                "format": {
+                    "type": "json_schema",
+                    "name": tier,
+                    "strict": True,
+                    "schema": strict_json_schema(tier_config["text_format"]),
+                }
+            },
+            max_output_tokens=tier_config["max_output_tokens"],
+        )
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+
+    result["output_tokens"] = response.usage.output_tokens
+    try:
+        parsed_output = tier_config["text_format"].model_validate_json(
+            response.output_text
+        )
+        result["response"] = parsed_output.model_dump()
+    except ValidationError as e:
+        # The output is cut off if it hits `max_output_tokens`, which makes it invalid JSON
+        result["error"] = f"Invalid output (status: {response.status}): {e}"
+    return result
+
+
+def run_tier(items, tier, n_threads=3):
+    return thread_map(
+        lambda item: process_text_message(item, tier),
+        items,
+        max_workers=n_threads,
+        desc=f"{tier} pass",
+    )
+
+
+#######################################
+# Choose which messages get an explanation
+
+
+def select_for_explanation(score_results, borderline=0.3, sample_fraction=0.1, seed=42):
+    """Map each ID that should go through the explanation pass to the reason it was selected.
+
+    A message is selected if the score-only pass failed ("failed"), if its score is borderline
+    (`abs(score) <= borderline`, "borderline"), or if it is drawn in a random sample of `sample_fraction`
+    of the rest ("sample"). At least one message is sampled unless `sample_fraction` is 0.
+    """
+    selected = {}
+    rest = []
+    for result in score_results:
+        if "error" in result:
+            selected[result["id"]] = "failed"
+        elif abs(result["response"]["score"]) <= borderline:
+            selected[result["id"]] = "borderline"
+        else:
+            rest.append(result["id"])
+    # Fix the seed so the same messages are selected if the script is re-run.
+    # Sample at least one message so the savings can always be estimated.
+    n_sample = round(len(rest) * sample_fraction)
+    if rest and sample_fraction > 0:
+        n_sample = max(1, n_sample)
+    for item_id in random.Random(seed).sample(rest, n_sample):
+        selected[item_id] = "sample"
+    return selected
+
+
+#######################################
+# Merge the passes and report the savings
+
+
+def merge_by_id(items, score_results, explanation_results):
+    score_by_id = {result["id"]: result for result in score_results}
+    explanation_by_id = {result["id"]: result for result in explanation_results}
+    merged = []
+    for item in items:
+        score_result = score_by_id[item["id"]]
+        explanation_result = explanation_by_id.get(item["id"], {})
+        record = {
+            "id": item["id"],
+            "text_message": item["text_message"],
+            "score": score_result.get("response", {}).get("score"),
+            "explanation": explanation_result.get("response", {}).get("explanation"),
+        }
+        # Fall back to the score from the explanation pass if the score-only pass failed
+        if record["score"] is None:
+            record["score"] = explanation_result.get("response", {}).get("score")
+        if record["score"] is None:
+            record["error"] = explanation_result.get("error") or score_result.get(
+                "error"
+            )
+        merged.append(record)
+    return merged
+
+
+def token_report(score_results, explanation_results, selection):
+    score_tokens = sum(result.get("output_tokens", 0) for result in score_results)
+    explanation_tokens = sum(
+        result.get("output_tokens", 0) for result in explanation_results
+    )
+    used_tokens = score_tokens + explanation_tokens
+    # Estimate what a single pass with explanations for every message would have cost.
+    # Borderline and failed messages aren't typical, so only the random sample is used for the estimate.
+    sampled = [
+        result
+        for result in explanation_results
+        if selection.get(result["id"]) == "sample" and "output_tokens" in result
+    ]
+    if sampled:
+        tokens_per_explanation = sum(
+            result["output_tokens"] for result in sampled
+        ) / len(sampled)
+        full_run_tokens = tokens_per_explanation * len(score_results)
+    else:
+        full_run_tokens = None
+    return {
+        "score_pass_output_tokens": score_tokens,
+        "explanation_pass_output_tokens": explanation_tokens,
+        "n_explained": len(explanation_results),
+        "n_sampled": len(sampled),
+        "total_output_tokens": used_tokens,
+        "estimated_full_run_output_tokens": full_run_tokens,
+        "estimated_savings": (
+            1 - used_tokens / full_run_tokens if full_run_tokens else None
+        ),
+    }
+
+
+if __name__ == "__main__":
+    # Assign a unique ID to each message so the two passes can be merged
+    items = [
+        {"id": f"text_message_{index}", "text_message": text_message}
+        for index, text_message in enumerate(text_messages)
+    ]
+
+    score_results = run_tier(items, "score")
+    selection = select_for_explanation(score_results)
+    explanation_results = run_tier(
+        [item for item in items if item["id"] in selection], "explanation"
+    )
+
+    for record in merge_by_id(items, score_results, explanation_results):
+        print(record)
+
+    report = token_report(score_results, explanation_results, selection)
+    print(
+        f"Output tokens: {report['score_pass_output_tokens']} (score pass) + "
+        f"{report['explanation_pass_output_tokens']} "
+        f"(explanation pass, {report['n_explained']} messages) = "
+        f"{report['total_output_tokens']}"
+    )
+    if report["estimated_full_run_output_tokens"] is not None:
+        print(
+            f"Estimated output tokens with explanations for every message: "
+            f"{report['estimated_full_run_output_tokens']:.0f} "
+            f"(saved {report['estimated_savings']:.0%}, "
+            f"based on {report['n_sampled']} randomly sampled messages)"
+        )
+    else:
+        print(
+            "No randomly sampled messages were explained, increase `sample_fraction` to estimate the savings"
+        )